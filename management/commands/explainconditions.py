@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 coding=utf-8
+'''
+Provides the explainconditions command to ./manage
+
+Optionally takes an app name, or it will check any models that subclass
+ConditionClass in every app.
+
+Checking consists of:
+    1.  Look up the indexes defined in conditions/sql for the database in use
+        and report any that are missing from the database, along with the
+        CREATE INDEX statement that adds it.
+
+    2.  Run EXPLAIN on the queries that processconditions hits the hardest:
+            -The open conditions of each class (content_type, ended is null)
+            -The open condition of a single object (content_type, object_id,
+             ended is null)
+            -The latest action of a condition (condition, name, action_type,
+             ordered by executed). This one is the same for every class, so
+             it is only explained once.
+        A plan is flagged if the index the database picks isn't the one
+        meant for it, if it scans a table sequentially, or if it sorts the
+        rows instead of reading them in index order.
+
+Plans are only checked for tables with at least --min-rows rows (estimated
+from the database statistics where the backend keeps them). Small tables are
+scanned sequentially by the database no matter what indexes exist. Plans that
+aren't checked, because the table is too small, has no statistics yet, or the
+condition class has never been processed, are listed as such.
+
+The command only reads from the database; it never creates the ContentType
+of a condition class the way processconditions does.
+
+The indexes are created by syncdb along with the tables. For tables that
+already existed, run only the CREATE INDEX statements this command reports
+as missing; the statements have no IF NOT EXISTS guard, so re-running all of
+./manage.py sqlcustom conditions fails on the indexes that are already there.
+
+Takes two optional arguments:
+
+    --all: Explicitly check all apps (default behavior)
+    --min-rows: Smallest table size for which a query plan is flagged
+'''
+
+import re
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.core.management.sql import custom_sql_for_model
+from django.db import connections
+from django.utils.translation import ugettext as _
+
+from ...models import Condition, Action
+from .processconditions import Command as ProcessConditionsCommand
+
+
+class Command(BaseCommand):
+    '''
+    Django command extension, provides ./manage explainconditions
+    '''
+
+    args = '[appname] [--all] [--min-rows=N]'
+    help = _(u"Explain the condition queries and flag missing indexes")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--all',
+            action='store_true',
+            dest='all_apps',
+            default=False,
+            help=_(u"Check conditions for all apps")),
+
+        make_option('--min-rows',
+            action='store',
+            type='int',
+            dest='min_rows',
+            default=10000,
+            help=_(u"Only flag query plans on tables with at least "
+                   u"this many rows")),
+    )
+
+    '''
+    Names of the indexes (from conditions/sql) that each hot query can use.
+    Only the ones defined for the database in use are checked for.
+    '''
+    CONDITION_INDEXES = ('conditions_condition_open',
+                         'conditions_condition_ct_ended_obj')
+    ACTION_INDEXES = ('conditions_action_cond_type_name_exec',)
+
+    def __init__(self):
+        super(Command, self).__init__()
+        self.connection = connections[Condition.objects.db]
+        self.row_counts = {}
+
+    def handle(self, app=None, *args, **options):
+        '''
+        Main handle method that will be called
+        '''
+        if options.get('all_apps', False):
+            app = None
+
+        min_rows = options.get('min_rows', 10000)
+        verbosity = int(options.get('verbosity', 1))
+        classes = ProcessConditionsCommand().condition_classes(app)
+
+        self.table_names = self.connection.introspection.table_names()
+        problems = []
+        not_checked = []
+        checked = 0
+
+        indexes = self.custom_indexes()
+        for name in sorted(indexes):
+            table, statement = indexes[name]
+            if name not in self.database_indexes(table):
+                problems.append(_(u"Index %(index)s is missing, create it "
+                                  u"with:\n%(sql)s") % {'index': name,
+                                                        'sql': statement})
+
+        queries = []
+        for cls in classes:
+            ct = self.content_type(cls)
+            if ct is None:
+                not_checked.append(_(u"%(cls)s: not checked, it has never "
+                                     u"been processed by processconditions")
+                                   % {'cls': cls.__name__})
+            else:
+                queries.extend(self.condition_queries(cls, ct))
+        queries.append(self.action_query())
+
+        for label, qs, expected in queries:
+            expected = [name for name in expected if name in indexes]
+            plan, tables, used, sorts = self.explain(qs)
+
+            if verbosity > 1:
+                self.stdout.write(u"%s\n%s\n" % (label, u"\n".join(plan)))
+
+            table = qs.model._meta.db_table
+            rows = self.table_rows(table)
+            if rows is None:
+                not_checked.append(_(u"%(label)s: not checked, %(table)s "
+                                     u"has no statistics yet, run ANALYZE")
+                                   % {'label': label, 'table': table})
+                continue
+            if rows < min_rows:
+                not_checked.append(_(u"%(label)s: not checked, %(table)s "
+                                     u"has %(rows)d rows, below --min-rows")
+                                   % {'label': label, 'table': table,
+                                      'rows': rows})
+                continue
+
+            checked += 1
+            for scanned in tables:
+                problems.append(_(u"%(label)s: sequential scan on "
+                                  u"%(table)s") % {'label': label,
+                                                   'table': scanned})
+            if sorts:
+                problems.append(_(u"%(label)s: sorts %(table)s instead of "
+                                  u"reading it in index order") % {
+                                    'label': label, 'table': table})
+            if expected and not set(expected) & set(used):
+                problems.append(_(u"%(label)s: uses %(used)s instead of "
+                                  u"%(indexes)s") % {
+                                    'label': label,
+                                    'used': u", ".join(used) or _(u"no "
+                                                                  u"index"),
+                                    'indexes': _(u" or ").join(expected)})
+
+        if verbosity > 0:
+            for note in not_checked:
+                self.stdout.write(note + u"\n")
+
+        if problems:
+            raise CommandError(u"\n".join(problems))
+
+        if verbosity > 0:
+            if checked:
+                self.stdout.write(_(u"%(count)d plans checked, all of them "
+                                    u"use their indexes\n")
+                                  % {'count': checked})
+            if not_checked:
+                self.stdout.write(_(u"%(count)d checks skipped, see "
+                                    u"above\n") % {'count': len(not_checked)})
+
+    def content_type(self, cls):
+        '''
+        Return the ContentType of the condition class cls, or None if it
+        doesn't exist yet. Unlike cls.get_ct(), this never creates it.
+        '''
+        try:
+            return ContentType.objects.get(
+                app_label=cls._meta.app_label,
+                model=cls._meta.object_name.lower())
+        except ContentType.DoesNotExist:
+            return None
+
+    def condition_queries(self, cls, ct):
+        '''
+        Return a list of (label, queryset, index names) tuples for the
+        Condition queries run for every object of cls while processing
+        conditions. A placeholder object_id is used; it doesn't change the
+        plan.
+        '''
+        open_conditions = Condition.objects.open_conditions() \
+                                           .filter(content_type=ct)
+        return [
+            (_(u"%(cls)s: open conditions") % {'cls': cls.__name__},
+             open_conditions.values_list('object_id', flat=True),
+             self.CONDITION_INDEXES),
+
+            (_(u"%(cls)s: open condition of an object")
+                % {'cls': cls.__name__},
+             open_conditions.filter(object_id=0),
+             self.CONDITION_INDEXES),
+        ]
+
+    def action_query(self):
+        '''
+        Return the (label, queryset, index names) tuple for the latest action
+        query. It is the same for every condition class. Placeholder values
+        are used for condition and name; they don't change the plan.
+        '''
+        return (_(u"latest action"),
+                Action.objects.filter(condition__pk=0, name='',
+                                      action_type=Action.RECURRING)
+                              .order_by('-executed')[:1],
+                self.ACTION_INDEXES)
+
+    def custom_indexes(self):
+        '''
+        Return a dict mapping the name of every index created by the
+        conditions/sql files for the database in use to a (table, statement)
+        tuple.
+        '''
+        indexes = {}
+        for model in (Condition, Action):
+            for statement in custom_sql_for_model(model, no_style(),
+                                                  self.connection):
+                match = re.search(r'CREATE\s+INDEX\s+(\w+)\s+ON\s+(\w+)',
+                                  statement, re.I)
+                if match:
+                    indexes[match.group(1)] = (match.group(2),
+                                               statement.strip())
+        return indexes
+
+    def database_indexes(self, table):
+        '''
+        Return the names of the indexes that exist on table.
+        '''
+        vendor = self.connection.vendor
+        cursor = self.connection.cursor()
+
+        if vendor == 'postgresql':
+            cursor.execute('SELECT indexname FROM pg_indexes '
+                           'WHERE tablename = %s', [table])
+            return [row[0] for row in cursor.fetchall()]
+
+        elif vendor == 'sqlite':
+            cursor.execute('PRAGMA index_list(%s)'
+                           % self.connection.ops.quote_name(table))
+            return [row[1] for row in cursor.fetchall()]
+
+        elif vendor == 'mysql':
+            cursor.execute('SHOW INDEX FROM %s'
+                           % self.connection.ops.quote_name(table))
+            return [row[2] for row in cursor.fetchall()]
+
+        raise CommandError(_(u"explainconditions does not support the "
+                             u"%(vendor)s database backend")
+                           % {'vendor': vendor})
+
+    def table_rows(self, table):
+        '''
+        Return the number of rows in table. PostgreSQL and MySQL estimates
+        are read from their statistics; SQLite keeps none, so its tables are
+        counted, at most once per run. Returns None for a PostgreSQL table
+        that has never been analyzed.
+        '''
+        if table in self.row_counts:
+            return self.row_counts[table]
+
+        vendor = self.connection.vendor
+        cursor = self.connection.cursor()
+
+        if vendor == 'postgresql':
+            cursor.execute('SELECT reltuples FROM pg_class '
+                           'WHERE relname = %s', [table])
+        elif vendor == 'mysql':
+            cursor.execute('SELECT table_rows FROM information_schema.tables '
+                           'WHERE table_schema = DATABASE() '
+                           'AND table_name = %s', [table])
+        else:
+            cursor.execute('SELECT COUNT(*) FROM %s'
+                           % self.connection.ops.quote_name(table))
+
+        row = cursor.fetchone()
+        rows = int(row and row[0] or 0)
+        if vendor == 'postgresql' and rows <= 0:
+            rows = None
+        self.row_counts[table] = rows
+        return self.row_counts[table]
+
+    def explain(self, qs):
+        '''
+        Run EXPLAIN on the query set and return a tuple of the plan (a list
+        of lines), the tables that are scanned sequentially, the names of the
+        indexes the database picked, and whether the rows are sorted instead
+        of read in index order.
+        '''
+        vendor = self.connection.vendor
+        sql, params = qs.query.get_compiler(using=qs.db).as_sql()
+        cursor = self.connection.cursor()
+
+        if vendor == 'postgresql':
+            cursor.execute('EXPLAIN ' + sql, params)
+            return self.parse_postgresql(cursor.fetchall(), self.table_names)
+
+        elif vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return self.parse_sqlite(cursor.fetchall(), self.table_names)
+
+        elif vendor == 'mysql':
+            cursor.execute('EXPLAIN ' + sql, params)
+            columns = [col[0] for col in cursor.description]
+            return self.parse_mysql(columns, cursor.fetchall(),
+                                    self.table_names)
+
+        raise CommandError(_(u"explainconditions does not support the "
+                             u"%(vendor)s database backend")
+                           % {'vendor': vendor})
+
+    def parse_postgresql(self, rows, table_names):
+        '''
+        Parse PostgreSQL EXPLAIN rows, which have a single text column:
+            Limit  (cost=...)
+              ->  Index Scan using conditions_condition_open on ...
+              ->  Sort  (cost=...)
+                    ->  Seq Scan on conditions_action  (cost=...)
+        '''
+        plan = [row[0] for row in rows]
+        tables = [line.split('Seq Scan on ', 1)[1].split()[0]
+                  for line in plan if 'Seq Scan on ' in line]
+        indexes = []
+        for line in plan:
+            match = re.search(r'Index (?:Only )?Scan(?: Backward)? using '
+                              r'(\w+)|Bitmap Index Scan on (\w+)', line)
+            if match:
+                indexes.append(match.group(1) or match.group(2))
+        sorts = bool([line for line in plan
+                      if re.search(r'(^|->)\s*Sort\s+\(', line)])
+        return (plan, [t for t in tables if t in table_names], indexes,
+                sorts)
+
+    def parse_sqlite(self, rows, table_names):
+        '''
+        Parse SQLite EXPLAIN QUERY PLAN rows, whose last column is the detail.
+        SQLite before 3.36 says "SCAN TABLE conditions_condition", later ones
+        "SCAN conditions_condition". SCAN lines also name things that aren't
+        tables (CONSTANT ROW, subqueries), so only known tables are kept.
+        The index picked follows "USING INDEX" or "USING COVERING INDEX".
+        '''
+        plan = [row[-1] for row in rows]
+        tables = []
+        indexes = []
+        for line in plan:
+            match = re.search(r'USING (?:COVERING )?INDEX (\w+)', line)
+            if match:
+                indexes.append(match.group(1))
+            words = line.split()
+            if words[:1] != ['SCAN'] or 'USING' in words or len(words) < 2:
+                continue
+            if words[1] == 'TABLE' and len(words) > 2:
+                words = words[1:]
+            if words[1] in table_names:
+                tables.append(words[1])
+        sorts = bool([line for line in plan
+                      if line.startswith('USE TEMP B-TREE FOR ORDER BY')])
+        return plan, tables, indexes, sorts
+
+    def parse_mysql(self, columns, rows, table_names):
+        '''
+        Parse MySQL EXPLAIN rows. A 'type' of ALL is a full table scan, the
+        index picked is in 'key' ('possible_keys' are only candidates), and
+        'Using filesort' in 'Extra' means the rows are sorted.
+        '''
+        rows = [dict(zip(columns, row)) for row in rows]
+        plan = [u", ".join(u"%s=%s" % (col, row[col]) for col in columns)
+                for row in rows]
+        tables = [row['table'] for row in rows
+                  if row['type'] == 'ALL' and row['table'] in table_names]
+        indexes = []
+        for row in rows:
+            if row.get('key'):
+                indexes.extend(row['key'].split(','))
+        sorts = bool([row for row in rows
+                      if 'Using filesort' in (row.get('Extra') or '')])
+        return plan, tables, indexes, sorts
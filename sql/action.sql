@@ -0,0 +1,8 @@
+-- Composite index for the hot Action lookups. Django runs this file after
+-- creating the conditions_action table (syncdb).
+--
+-- ConditionClass.get_triggered_delayed_actions() and
+-- get_triggered_recurring_actions() filter on (condition, name, action_type)
+-- and the latter orders by executed through .latest():
+CREATE INDEX conditions_action_cond_type_name_exec
+    ON conditions_action (condition_id, action_type, name, executed);
@@ -0,0 +1,10 @@
+-- Index for the hot Condition lookups. Django runs this file after creating
+-- the conditions_condition table (syncdb).
+--
+-- ConditionClassManager._get_ids_with_conditions() filters on
+-- (content_type, ended IS NULL) and only reads object_id, and
+-- ConditionClass.get_or_create_condition() adds object_id to that filter.
+-- PostgreSQL gets a partial index for this instead, see
+-- condition.postgresql_psycopg2.sql.
+CREATE INDEX conditions_condition_ct_ended_obj
+    ON conditions_condition (content_type_id, ended, object_id);
@@ -0,0 +1,8 @@
+-- A partial index covering just the open conditions, which is what every
+-- hot lookup asks for. It stays small as closed conditions accumulate, and
+-- replaces the full (content_type_id, ended, object_id) index used on
+-- SQLite and MySQL. SQLite only supports partial indexes from 3.8.0, so
+-- they are limited to PostgreSQL (and PostGIS, which uses this same file).
+CREATE INDEX conditions_condition_open
+    ON conditions_condition (content_type_id, object_id)
+    WHERE ended IS NULL;
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4 coding=utf-8
+'''
+Tests for conditions
+'''
+
+from StringIO import StringIO
+
+from django.core.management.base import CommandError
+from django.test import TestCase
+
+from .management.commands import processconditions
+from .management.commands.explainconditions import Command
+
+
+class ExplainParsingTest(TestCase):
+    '''
+    Tests for the query plan parsing of the explainconditions command.
+    '''
+
+    TABLES = ['conditions_condition', 'conditions_action']
+
+    def setUp(self):
+        self.command = Command()
+
+    def test_sqlite_old_format(self):
+        rows = [
+            (0, 0, 0, u"SCAN TABLE conditions_action (~100000 rows)"),
+            (0, 0, 0, u"USE TEMP B-TREE FOR ORDER BY")]
+        plan, tables, indexes, sorts = self.command.parse_sqlite(
+            rows, self.TABLES)
+        self.assertEqual(tables, ['conditions_action'])
+        self.assertEqual(indexes, [])
+        self.assertTrue(sorts)
+
+    def test_sqlite_old_format_index(self):
+        rows = [
+            (0, 0, 0, u"SCAN TABLE conditions_condition USING COVERING "
+                      u"INDEX conditions_condition_ct_ended_obj "
+                      u"(~100000 rows)"),
+            (0, 0, 0, u"SEARCH TABLE conditions_condition USING INDEX "
+                      u"conditions_condition_content_type_id "
+                      u"(content_type_id=?) "
+                      u"(~10 rows)")]
+        plan, tables, indexes, sorts = self.command.parse_sqlite(
+            rows, self.TABLES)
+        self.assertEqual(tables, [])
+        self.assertEqual(indexes, ['conditions_condition_ct_ended_obj',
+                                   'conditions_condition_content_type_id'])
+        self.assertFalse(sorts)
+        self.assertEqual(plan, [row[-1] for row in rows])
+
+    def test_sqlite_new_format(self):
+        rows = [
+            (2, 0, 0, u"SCAN conditions_condition"),
+            (3, 0, 0, u"SCAN CONSTANT ROW"),
+            (4, 0, 0, u"SCAN (subquery-1)"),
+            (5, 0, 0, u"SEARCH conditions_action USING COVERING INDEX "
+                      u"conditions_action_cond_type_name_exec "
+                      u"(condition_id=? AND action_type=? AND name=?)")]
+        plan, tables, indexes, sorts = self.command.parse_sqlite(
+            rows, self.TABLES)
+        self.assertEqual(tables, ['conditions_condition'])
+        self.assertEqual(indexes, ['conditions_action_cond_type_name_exec'])
+        self.assertFalse(sorts)
+
+    def test_postgresql(self):
+        rows = [
+            (u"Limit  (cost=8.17..8.18 rows=1 width=136)",),
+            (u"  ->  Sort  (cost=8.17..8.18 rows=1 width=136)",),
+            (u"        Sort Key: executed DESC",),
+            (u"        ->  Seq Scan on conditions_action  "
+             u"(cost=0.00..8.16 rows=1 width=136)",)]
+        plan, tables, indexes, sorts = self.command.parse_postgresql(
+            rows, self.TABLES)
+        self.assertEqual(tables, ['conditions_action'])
+        self.assertEqual(indexes, [])
+        self.assertTrue(sorts)
+
+    def test_postgresql_index(self):
+        rows = [
+            (u"Index Scan using conditions_condition_open on "
+             u"conditions_condition  (cost=0.29..8.30 rows=1 width=24)",),
+            (u"  Index Cond: (content_type_id = 12)",)]
+        plan, tables, indexes, sorts = self.command.parse_postgresql(
+            rows, self.TABLES)
+        self.assertEqual(tables, [])
+        self.assertEqual(indexes, ['conditions_condition_open'])
+        self.assertFalse(sorts)
+
+    def test_postgresql_bitmap_index(self):
+        rows = [
+            (u"Bitmap Heap Scan on conditions_condition  "
+             u"(cost=4.30..12.50 rows=10 width=4)",),
+            (u"  ->  Bitmap Index Scan on conditions_condition_open  "
+             u"(cost=0.00..4.30 rows=10 width=0)",)]
+        plan, tables, indexes, sorts = self.command.parse_postgresql(
+            rows, self.TABLES)
+        self.assertEqual(indexes, ['conditions_condition_open'])
+
+    def test_mysql(self):
+        columns = ['id', 'select_type', 'table', 'type', 'possible_keys',
+                   'key', 'key_len', 'ref', 'rows', 'Extra']
+        rows = [
+            (1, 'SIMPLE', 'conditions_action', 'ALL', None, None, None,
+             None, 100000, 'Using where; Using filesort')]
+        plan, tables, indexes, sorts = self.command.parse_mysql(
+            columns, rows, self.TABLES)
+        self.assertEqual(tables, ['conditions_action'])
+        self.assertEqual(indexes, [])
+        self.assertTrue(sorts)
+
+    def test_mysql_index(self):
+        columns = ['id', 'select_type', 'table', 'type', 'possible_keys',
+                   'key', 'key_len', 'ref', 'rows', 'Extra']
+        rows = [
+            (1, 'SIMPLE', 'conditions_action', 'ref',
+             'conditions_action_cond_type_name_exec',
+             'conditions_action_cond_type_name_exec', '310',
+             'const,const,const', 1, 'Using where')]
+        plan, tables, indexes, sorts = self.command.parse_mysql(
+            columns, rows, self.TABLES)
+        self.assertEqual(tables, [])
+        self.assertEqual(indexes, ['conditions_action_cond_type_name_exec'])
+        self.assertFalse(sorts)
+
+    def test_mysql_possible_key_not_used(self):
+        columns = ['id', 'select_type', 'table', 'type', 'possible_keys',
+                   'key', 'key_len', 'ref', 'rows', 'Extra']
+        rows = [
+            (1, 'SIMPLE', 'conditions_action', 'ref',
+             'conditions_action_condition_id,'
+             'conditions_action_cond_type_name_exec',
+             'conditions_action_condition_id', '4', 'const', 10,
+             'Using where')]
+        plan, tables, indexes, sorts = self.command.parse_mysql(
+            columns, rows, self.TABLES)
+        self.assertEqual(indexes, ['conditions_action_condition_id'])
+        self.assertFalse(set(Command.ACTION_INDEXES) & set(indexes))
+
+
+class ExplainIndexesTest(TestCase):
+    '''
+    Tests that the conditions/sql files create their indexes in the test
+    database, and that explainconditions reports the ones that are missing.
+    '''
+
+    def setUp(self):
+        self.command = Command()
+        self.command.stdout = StringIO()
+        self.condition_classes = \
+            processconditions.Command.condition_classes
+        processconditions.Command.condition_classes = \
+            lambda self, app=None: []
+
+    def tearDown(self):
+        processconditions.Command.condition_classes = \
+            self.condition_classes
+
+    def test_custom_indexes_created(self):
+        indexes = self.command.custom_indexes()
+        if self.command.connection.vendor == 'postgresql':
+            condition_index = 'conditions_condition_open'
+        else:
+            condition_index = 'conditions_condition_ct_ended_obj'
+        self.assertEqual(sorted(indexes),
+                         ['conditions_action_cond_type_name_exec',
+                          condition_index])
+        for name, (table, statement) in indexes.items():
+            self.assertTrue(name in self.command.database_indexes(table))
+
+    def test_missing_index_reported(self):
+        connection = self.command.connection
+        name = 'conditions_action_cond_type_name_exec'
+        table, statement = self.command.custom_indexes()[name]
+
+        cursor = connection.cursor()
+        if connection.vendor == 'mysql':
+            cursor.execute('DROP INDEX %s ON %s' % (name, table))
+        else:
+            cursor.execute('DROP INDEX %s' % name)
+        try:
+            try:
+                self.command.handle()
+            except CommandError as e:
+                self.assertTrue(statement in unicode(e))
+            else:
+                self.fail("Missing index %s not reported" % name)
+        finally:
+            cursor.execute(statement.rstrip(';'))
+
+    def test_small_tables_not_reported_as_checked(self):
+        self.command.handle()
+        output = self.command.stdout.getvalue()
+        self.assertTrue('below --min-rows' in output)
+        self.assertFalse('plans checked' in output)